@@ -14,6 +14,20 @@ let activeRequestId = null;
 // Network request tracking per tab
 let networkRequests = new Map();
 
+// Whether to ask the native host for prompt/response previews (Logs panel)
+let logPreviews = false;
+
+browser.storage.local.get('settings').then((stored) => {
+  logPreviews = !!(stored.settings && stored.settings.logPreviews);
+});
+
+browser.storage.onChanged.addListener((changes, area) => {
+  if (area === 'local' && changes.settings) {
+    const settings = changes.settings.newValue;
+    logPreviews = !!(settings && settings.logPreviews);
+  }
+});
+
 /**
  * Initialize or get native messaging connection
  */
@@ -72,6 +86,9 @@ function sendNativeMessage(message) {
   return new Promise((resolve, reject) => {
     const requestId = ++requestIdCounter;
     message.requestId = requestId;
+    if (logPreviews) {
+      message.debug = true;
+    }
 
     const startTime = Date.now();
     pendingRequests.set(requestId, { resolve, reject, startTime });
@@ -10,7 +10,8 @@ class FireClaudeSidebar {
     this.logs = [];
     this.selectedModel = 'sonnet'; // Default to Sonnet 4.5
     this.settings = {
-      promptSizeLimit: 10000  // Default 10KB, max 20KB
+      promptSizeLimit: 10000,  // Default 10KB, max 20KB
+      logPreviews: false       // Ask the native host for prompt/response previews
     };
 
     this.init();
@@ -31,6 +32,10 @@ class FireClaudeSidebar {
       if (input) {
         input.value = this.settings.promptSizeLimit;
       }
+      const previews = document.getElementById('logPreviews');
+      if (previews) {
+        previews.checked = this.settings.logPreviews;
+      }
     } catch (error) {
       console.error('Failed to load settings:', error);
     }
@@ -49,6 +54,7 @@ class FireClaudeSidebar {
 
     this.settings.promptSizeLimit = limit;
     input.value = limit; // Update UI to show enforced value
+    this.settings.logPreviews = document.getElementById('logPreviews').checked;
 
     try {
       await browser.storage.local.set({ settings: this.settings });
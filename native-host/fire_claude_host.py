@@ -6,139 +6,474 @@ Bridges Firefox extension to Claude Code CLI.
 
 import sys
 import os
+import functools
 import json
 import struct
 import subprocess
-import shutil
 import threading
+import concurrent.futures
+import queue
+import signal
 import time
 import logging
-import tempfile
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, IO, Iterable, Tuple, Union
+
+# msgspec (or else orjson) encodes/decodes much faster than the stdlib json
+# module and works on bytes directly, but the host must still run on a bare
+# Python install.
+try:
+    import msgspec
+    _encoder = msgspec.json.Encoder()
+    _decoder = msgspec.json.Decoder()
+    orjson = None
+except ImportError:
+    msgspec = None
+    try:
+        import orjson
+    except ImportError:
+        orjson = None
 
-# Debug logging to file (helps diagnose timeout issues)
+# Debug logging to file (helps diagnose timeout issues).
+# Only warnings and errors are written unless FIRE_CLAUDE_DEBUG is set.
 LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fire_claude_debug.log')
 logging.basicConfig(
     filename=LOG_FILE,
-    level=logging.DEBUG,
+    level=logging.DEBUG if os.environ.get('FIRE_CLAUDE_DEBUG') else logging.WARNING,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-# Track active processes for cancellation
+# Reusable receive buffer for incoming frames up to 1MB; larger frames get a
+# one-off buffer so their memory isn't held for the rest of the session
+_read_buffer = bytearray(1 << 20)
+
+# Track active processes for cancellation. Each request_id is only written
+# by its own worker, and single-key dict operations are atomic, so no lock.
 active_processes: Dict[int, subprocess.Popen] = {}
-process_lock = threading.Lock()
 
-# Cache for claude path
-_claude_path: Optional[str] = None
+# Queries run on worker threads so the main loop keeps reading messages
+# (e.g. a cancel) while claude is busy
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+
+# Set when the extension disconnects; queued and in-flight queries must not
+# start new claude processes after that
+shutting_down = threading.Event()
+
+# Responses are length-prefixed frames; writes from workers must not interleave
+send_lock = threading.Lock()
+
+# Opt-in: keep one long-lived claude process per model instead of starting a
+# new one (and Node.js with it) for every query. The CLI keeps a single
+# conversation per process, so earlier prompts stay in its context.
+PERSISTENT_SESSIONS = bool(os.environ.get('FIRE_CLAUDE_PERSISTENT'))
+
+# A session is replaced after this many prompts, or once this many characters
+# of prompt and response text have gone through it, so its conversation
+# doesn't keep growing with every page
+SESSION_MAX_TURNS = 10
+SESSION_MAX_CHARS = 200_000
+
+# Persistent sessions by model; creation is serialized by session_lock
+sessions: Dict[str, 'ClaudeSession'] = {}
+session_lock = threading.Lock()
 
 # Valid model aliases for Claude Code CLI
 # Claude Code accepts simple aliases: 'sonnet', 'opus', 'haiku'
-VALID_MODELS = {'sonnet', 'opus', 'haiku'}
+VALID_MODELS = frozenset(('sonnet', 'opus', 'haiku'))
 
+# claude is launched from an argv list (no shell), so on Windows suppress the
+# console window a .cmd launcher would otherwise flash
+POPEN_CREATIONFLAGS = subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
 
-def find_claude() -> Optional[str]:
-    """Find the claude executable in common locations."""
-    global _claude_path
+# Prompt for suggest_dom_changes; only {request} is filled in per call
+DOM_CHANGES_PROMPT = """User request: {request}
 
-    if _claude_path:
-        return _claude_path
+Suggest specific DOM changes as a JSON array. Each change should have:
+- "action": one of "setText", "setHTML", "setAttribute", "addClass", "removeClass", "setStyle", "remove"
+- "selector": CSS selector for the target element
+- For setText/setHTML: "value" with the new content
+- For setAttribute: "attribute" and "value"
+- For addClass/removeClass: "className"
+- For setStyle: "property" and "value"
 
-    # Try shutil.which first (checks PATH)
-    path = shutil.which('claude')
-    if path:
-        _claude_path = path
-        return path
+Example response format:
+```json
+[
+  {{"action": "setText", "selector": "h1.title", "value": "New Title"}},
+  {{"action": "setStyle", "selector": ".sidebar", "property": "display", "value": "none"}}
+]
+```
 
-    # On Windows, also try .cmd extension
-    if sys.platform == 'win32':
-        path = shutil.which('claude.cmd')
-        if path:
-            _claude_path = path
-            return path
+Respond with ONLY the JSON array, no other text."""
 
-    # Common Windows locations for npm global packages
+
+@functools.lru_cache(maxsize=None)
+def claude_candidate_paths() -> Tuple[str, ...]:
+    """Common install locations to check when claude isn't on PATH."""
     if sys.platform == 'win32':
+        # Common Windows locations for npm global packages. Only .cmd launchers
+        # are listed; the bare npm shim can't be run without a shell.
         appdata = os.environ.get('APPDATA', '')
         localappdata = os.environ.get('LOCALAPPDATA', '')
         userprofile = os.environ.get('USERPROFILE', '')
+        chocolatey = os.environ.get('ChocolateyInstall', 'C:\\ProgramData\\chocolatey')
 
-        possible_paths = [
-            os.path.join(appdata, 'npm', 'claude.cmd'),
-            os.path.join(appdata, 'npm', 'claude'),
-            os.path.join(localappdata, 'npm', 'claude.cmd'),
-            os.path.join(localappdata, 'npm', 'claude'),
-            os.path.join(userprofile, 'AppData', 'Roaming', 'npm', 'claude.cmd'),
-            os.path.join(userprofile, 'AppData', 'Local', 'npm', 'claude.cmd'),
+        return (
+            appdata + '\\npm\\claude.cmd',
+            localappdata + '\\npm\\claude.cmd',
+            userprofile + '\\AppData\\Roaming\\npm\\claude.cmd',
+            userprofile + '\\AppData\\Local\\npm\\claude.cmd',
             # Node Version Manager (nvm) paths
-            os.path.join(appdata, 'nvm', 'current', 'claude.cmd'),
+            appdata + '\\nvm\\current\\claude.cmd',
             # Scoop
-            os.path.join(userprofile, 'scoop', 'shims', 'claude.cmd'),
+            userprofile + '\\scoop\\shims\\claude.cmd',
             # Chocolatey
-            os.path.join(os.environ.get('ChocolateyInstall', 'C:\\ProgramData\\chocolatey'), 'bin', 'claude.cmd'),
-        ]
-
-        for p in possible_paths:
-            if os.path.isfile(p):
-                _claude_path = p
-                return p
+            chocolatey + '\\bin\\claude.cmd',
+        )
 
     # macOS/Linux locations
+    home = os.path.expanduser('~')
+    return (
+        '/usr/local/bin/claude',
+        '/usr/bin/claude',
+        home + '/.npm-global/bin/claude',
+        home + '/.nvm/current/bin/claude',
+    )
+
+
+def find_claude() -> Optional[str]:
+    """Find the claude executable, caching only a successful lookup."""
+    path = search_claude()
+    if path is None:
+        # Don't cache the miss, so installing Claude Code doesn't need a browser restart
+        search_claude.cache_clear()
+    return path
+
+
+@functools.lru_cache(maxsize=None)
+def search_claude() -> Optional[str]:
+    """Search PATH and common install locations for the claude executable."""
+    # Walk PATH once, trying every executable name in each directory.
+    # On Windows the bare 'claude' npm shim is a shell script that can't be
+    # executed directly, so only the .exe/.cmd variants count.
+    if sys.platform == 'win32':
+        names = ('claude.exe', 'claude.cmd')
     else:
-        home = os.path.expanduser('~')
-        possible_paths = [
-            '/usr/local/bin/claude',
-            '/usr/bin/claude',
-            os.path.join(home, '.npm-global', 'bin', 'claude'),
-            os.path.join(home, '.nvm', 'current', 'bin', 'claude'),
-        ]
-
-        for p in possible_paths:
-            if os.path.isfile(p):
-                _claude_path = p
-                return p
+        names = ('claude',)
+
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        if not directory:
+            continue
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+
+    for path in claude_candidate_paths():
+        if os.path.isfile(path):
+            return path
 
     return None
 
 
+def json_encode(obj: Any) -> bytes:
+    """Serialize obj to compact UTF-8 JSON bytes."""
+    # The fast encoders refuse lone surrogates (e.g. an emoji cut in half by
+    # the content script's substring()), so those go through the stdlib path
+    try:
+        if msgspec is not None:
+            return _encoder.encode(obj)
+        if orjson is not None:
+            return orjson.dumps(obj)
+    except (TypeError, ValueError):
+        pass
+    try:
+        # ensure_ascii=False keeps non-ASCII text as raw UTF-8 instead of \uXXXX
+        # escapes, which matters against Firefox's 1MB frame limit.
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    except UnicodeEncodeError:
+        # Lone surrogates can't be encoded as UTF-8; \uXXXX escapes keep them valid JSON
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def json_decode(data: Union[bytes, memoryview]) -> Any:
+    """Deserialize UTF-8 JSON from a bytes-like object."""
+    # The fast decoders reject lone surrogate escapes that json.loads accepts,
+    # so retry with the stdlib before giving up on a frame
+    try:
+        if msgspec is not None:
+            return _decoder.decode(data)
+        if orjson is not None:
+            return orjson.loads(data)
+    except ValueError:
+        pass
+    return json.loads(bytes(data))
+
+
 def read_message() -> Optional[Dict[str, Any]]:
     """Read a message from stdin using native messaging protocol."""
     raw_length = sys.stdin.buffer.read(4)
     if len(raw_length) == 0:
         return None
     message_length = struct.unpack('@I', raw_length)[0]
-    message = sys.stdin.buffer.read(message_length).decode('utf-8')
-    return json.loads(message)
+
+    if message_length <= len(_read_buffer):
+        buffer = _read_buffer
+    else:
+        buffer = bytearray(message_length)
+
+    # Read the body straight into the buffer; a large frame may arrive in
+    # several chunks.
+    view = memoryview(buffer)
+    received = 0
+    while received < message_length:
+        n = sys.stdin.buffer.readinto(view[received:message_length])
+        if not n:
+            return None
+        received += n
+    return json_decode(view[:message_length])
 
 
 def send_message(message: Dict[str, Any]) -> None:
     """Send a message to stdout using native messaging protocol."""
-    encoded = json.dumps(message, separators=(',', ':')).encode('utf-8')
-    length = struct.pack('@I', len(encoded))
-    sys.stdout.buffer.write(length)
-    sys.stdout.buffer.write(encoded)
-    sys.stdout.buffer.flush()
+    encoded = json_encode(message)
+    # Header and body go out together, straight to the file descriptor,
+    # bypassing sys.stdout's buffer
+    frame = memoryview(struct.pack('@I', len(encoded)) + encoded)
+    fd = sys.stdout.fileno()
+    with send_lock:
+        while frame:
+            # Pipes may accept a large frame in several partial writes
+            frame = frame[os.write(fd, frame):]
+
+
+def write_prompt(stdin: IO[bytes], parts: Iterable[str]) -> None:
+    """Write prompt parts to a subprocess's stdin as UTF-8, then close it."""
+    try:
+        for part in parts:
+            # errors='replace': page text cut mid-emoji leaves lone surrogates
+            stdin.write(part.encode('utf-8', errors='replace'))
+    except OSError:
+        # claude exited (or was killed) before reading everything; its exit
+        # status is reported by query_claude instead
+        pass
+    finally:
+        # Always close, or claude waits for more input until the timeout
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+
+def kill_process_tree(process: subprocess.Popen) -> None:
+    """Kill a process together with the children it started.
+
+    On Windows claude is usually the npm claude.cmd shim, so killing the
+    process alone would only end cmd.exe and leave node running.
+    """
+    try:
+        if sys.platform == 'win32':
+            subprocess.run(
+                ['taskkill', '/T', '/F', '/PID', str(process.pid)],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                creationflags=POPEN_CREATIONFLAGS,
+            )
+        else:
+            # Started with start_new_session, so its pid is the group id
+            os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass  # already gone
+    try:
+        # Fallback, and makes sure the direct child is reaped
+        process.kill()
+    except OSError:
+        pass
+
+
+class ClaudeSession:
+    """A long-lived claude process that takes prompts as stream-json lines."""
+
+    def __init__(self, claude_path: str, model: str):
+        self.claude_path = claude_path
+        self.turn_lock = threading.Lock()  # the CLI answers one prompt at a time
+        self.started = False  # set once claude has written any output
+        self.turns = 0
+        self.context_chars = 0  # prompt and response text sent through so far
+        self.results: 'queue.Queue[Optional[Dict[str, Any]]]' = queue.Queue()
+        self.process = subprocess.Popen(
+            [claude_path, '-p', '--input-format', 'stream-json', '--output-format', 'stream-json',
+             '--verbose', '--model', model],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            creationflags=POPEN_CREATIONFLAGS,
+            # Own process group, so stop() can kill anything claude started
+            start_new_session=sys.platform != 'win32',
+        )
+        threading.Thread(target=self.read_events, daemon=True).start()
+
+    def alive(self) -> bool:
+        """True while the claude process is still running."""
+        return self.process.poll() is None
+
+    def stop(self) -> None:
+        """End the session: close stdin (claude exits on EOF), then kill the process tree."""
+        try:
+            self.process.stdin.close()
+        except (OSError, ValueError):
+            pass
+        kill_process_tree(self.process)
+        try:
+            # Reap it, so alive() is false before the next get_session()
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            pass
+
+    def read_events(self) -> None:
+        """Queue each 'result' event from claude's stdout; None marks exit."""
+        for line in self.process.stdout:
+            self.started = True
+            try:
+                event = json_decode(line)
+            except Exception:
+                continue
+            if isinstance(event, dict) and event.get('type') == 'result':
+                self.results.put(event)
+        self.results.put(None)
+
+    def exhausted(self) -> bool:
+        """True after SESSION_MAX_TURNS prompts or SESSION_MAX_CHARS characters of text."""
+        return self.turns >= SESSION_MAX_TURNS or self.context_chars >= SESSION_MAX_CHARS
+
+    def write_line(self, line: bytes) -> None:
+        """Write one stream-json line to claude's stdin (runs on its own thread)."""
+        try:
+            self.process.stdin.write(line)
+            self.process.stdin.flush()
+        except (OSError, ValueError):
+            pass  # claude exited or was killed; read_events reports it
+
+    def query(self, prompt: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Send one prompt and wait for its result event (None if claude exited)."""
+        message = {'type': 'user', 'message': {'role': 'user', 'content': prompt}}
+        # The write runs on its own thread so that a claude which stops
+        # reading is caught by the same timeout as one that stops answering
+        threading.Thread(target=self.write_line, args=(json_encode(message) + b'\n',),
+                         daemon=True).start()
+        self.turns += 1
+        self.context_chars += len(prompt)
+        try:
+            event = self.results.get(timeout=timeout)
+        except queue.Empty:
+            self.stop()
+            raise subprocess.TimeoutExpired(self.process.args, timeout)
+        if event is not None:
+            self.context_chars += len(event.get('result') or '')
+        return event
+
+
+def retire_session(model: str, session: ClaudeSession) -> None:
+    """Stop a session so the next query for model starts a fresh one."""
+    with session_lock:
+        if sessions.get(model) is session:
+            del sessions[model]
+    session.stop()
+
+
+def get_session(claude_path: str, model: str) -> Optional[ClaudeSession]:
+    """Return the live session for model, starting one if needed."""
+    with session_lock:
+        if shutting_down.is_set():
+            return None
+        session = sessions.get(model)
+        if session is None or not session.alive() or session.claude_path != claude_path:
+            try:
+                session = ClaudeSession(claude_path, model)
+            except OSError as e:
+                logging.warning("Could not start persistent claude session: %s", e)
+                return None
+            sessions[model] = session
+        return session
+
+
+def query_session(claude_path: str, model: str, prompt_parts: Iterable[str],
+                  request_id: int) -> Optional[Tuple[bool, str]]:
+    """Answer a prompt on the persistent session for model.
+
+    Returns (success, response), or None if the caller should fall back to a
+    one-shot claude process.
+    """
+    global PERSISTENT_SESSIONS
+
+    session = get_session(claude_path, model)
+    # A busy session would make this request wait behind another one
+    if session is None or not session.turn_lock.acquire(blocking=False):
+        return None
+
+    try:
+        # cancel_request kills the session process, and the next query starts a new one
+        active_processes[request_id] = session.process
+        event = session.query(''.join(prompt_parts), timeout=180)
+        # Retire while still holding turn_lock, so no other request can
+        # start a turn on the process being killed
+        if event is not None and session.exhausted():
+            retire_session(model, session)
+    except subprocess.TimeoutExpired:
+        logging.error("Persistent session timed out after 180s!")
+        return False, "Error: Claude Code request timed out (180s). This may indicate Claude Code CLI needs authentication or is prompting for input."
+    finally:
+        session.turn_lock.release()
+        cancelled = active_processes.pop(request_id, None) is None
+
+    if cancelled:
+        # Even if a result slipped out before the process died
+        return False, "Error: Request cancelled"
+    if event is not None:
+        if event.get('is_error'):
+            return False, f"Error: {event.get('result') or event.get('subtype', 'unknown error')}"
+        return True, event.get('result', '')
+    if not session.started:
+        # claude exited without any output: this CLI doesn't support stream-json
+        logging.warning("Persistent claude session unavailable, using one-shot processes")
+        PERSISTENT_SESSIONS = False
+        return None
+    return False, f"Error: Claude Code session exited (exit code {session.process.poll()})"
 
 
-def query_claude(prompt: str, context: str = "", request_id: int = 0, model: str = "sonnet") -> Dict[str, Any]:
-    """Send a query to Claude Code CLI and return response with metadata."""
-    logging.info(f"query_claude called: request_id={request_id}, model={model}, context_len={len(context)}, prompt_len={len(prompt)}")
+def query_claude(prompt: str, context: str = "", request_id: int = 0, model: str = "sonnet",
+                 debug: bool = False) -> Dict[str, Any]:
+    """Send a query to Claude Code CLI and return response with metadata.
 
-    full_prompt = f"{context}\n\n{prompt}" if context else prompt
-    # Validate model, default to sonnet if invalid
-    model_alias = model if model in VALID_MODELS else 'sonnet'
+    model must already be one of VALID_MODELS. Prompt/response previews are
+    only included when debug is set.
+    """
+    logging.info("query_claude called: request_id=%s, model=%s, context_len=%d, prompt_len=%d",
+                 request_id, model, len(context), len(prompt))
 
-    logging.info(f"Full prompt size: {len(full_prompt)} chars")
+    # The prompt is streamed to claude piece by piece and never joined in full
+    prompt_parts = (context, "\n\n", prompt) if context else (prompt,)
+    prompt_size = sum(len(part) for part in prompt_parts)
+
+    logging.info("Full prompt size: %d chars", prompt_size)
 
     start_time = time.time()
     result_data = {
-        'prompt_size': len(full_prompt),
-        'prompt_preview': full_prompt[:500] + ('...' if len(full_prompt) > 500 else ''),
-        'model_used': model_alias,  # Debug: show which model is being used
+        'prompt_size': prompt_size,
+        'model_used': model,  # Debug: show which model is being used
     }
 
+    if debug:
+        # Only join as much of the prompt as the preview needs
+        preview = ''
+        for part in prompt_parts:
+            preview += part[:500 - len(preview)]
+            if len(preview) >= 500:
+                break
+        result_data['prompt_preview'] = preview + ('...' if prompt_size > 500 else '')
+
     # Find claude executable
     claude_path = find_claude()
-    logging.info(f"Claude path found: {claude_path}")
+    logging.info("Claude path found: %s", claude_path)
     if not claude_path:
         result_data['duration_ms'] = 0
         result_data['response'] = (
@@ -154,63 +489,74 @@ def query_claude(prompt: str, context: str = "", request_id: int = 0, model: str
         result_data['success'] = False
         return result_data
 
-    temp_file = None
-    try:
-        # Write prompt to temp file - this works when user can grant permission
-        # (requires shell=True without CREATE_NO_WINDOW so permission dialog shows)
-        temp_file = tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False, encoding='utf-8')
-        temp_file.write(full_prompt)
-        temp_file.close()
-        logging.info(f"Wrote {len(full_prompt)} chars to temp file: {temp_file.name}")
+    if shutting_down.is_set():
+        result_data['duration_ms'] = 0
+        result_data['response'] = "Error: Native host is shutting down"
+        result_data['success'] = False
+        return result_data
 
-        if sys.platform == 'win32':
-            # On Windows, use 'type' to read the file and pipe to Claude's stdin
-            # This avoids Claude's file permission prompt entirely!
-            # type reads the file -> pipes to claude -p - (stdin mode)
-            cmd = f'type "{temp_file.name}" | "{claude_path}" -p - --model {model_alias}'
-            logging.info(f"Starting subprocess (type pipe): {cmd}")
-            process = subprocess.Popen(
-                cmd,
-                stdin=subprocess.DEVNULL,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                shell=True,
-            )
-        else:
-            # On Unix, use cat to pipe file content to stdin
-            cmd = f'cat "{temp_file.name}" | "{claude_path}" -p - --model {model_alias}'
-            logging.info(f"Starting subprocess (cat pipe): {cmd}")
-            process = subprocess.Popen(
-                cmd,
-                stdin=subprocess.DEVNULL,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                shell=True,
-            )
+    if PERSISTENT_SESSIONS:
+        session_result = query_session(claude_path, model, prompt_parts, request_id)
+        if session_result is not None:
+            success, response = session_result
+            result_data['duration_ms'] = int((time.time() - start_time) * 1000)
+            result_data['claude_path'] = claude_path  # Include for debugging
+            result_data['response'] = response.strip()
+            if success:
+                result_data['response_size'] = len(response)
+                if debug:
+                    result_data['response_preview'] = response[:500] + ('...' if len(response) > 500 else '')
+            result_data['success'] = success
+            return result_data
 
-        logging.info(f"Subprocess started with PID: {process.pid}")
+    try:
+        # Feed the prompt straight into claude's stdin (-p - reads it from there),
+        # which also avoids Claude's file permission prompt.
+        args = [claude_path, '-p', '-', '--model', model]
+        logging.info("Starting subprocess: %s", args)
+        process = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            creationflags=POPEN_CREATIONFLAGS,
+        )
+
+        logging.info("Subprocess started with PID: %s", process.pid)
 
         # Track process for cancellation
-        with process_lock:
-            active_processes[request_id] = process
+        active_processes[request_id] = process
+        # main() may have swept active_processes between the check above and
+        # the registration; don't leave this one running
+        if shutting_down.is_set():
+            process.kill()
+
+        # Hand stdin to a writer thread so communicate() only drains
+        # stdout/stderr; writing and reading at the same time means a full
+        # output pipe can't deadlock the prompt write
+        stdin, process.stdin = process.stdin, None
+        threading.Thread(target=write_prompt, args=(stdin, prompt_parts), daemon=True).start()
 
         try:
             logging.info("Waiting for subprocess to complete...")
             stdout, stderr = process.communicate(timeout=180)
-            logging.info(f"Subprocess completed. stdout={len(stdout)} chars, stderr={len(stderr)} chars")
+            logging.info("Subprocess completed. stdout=%d bytes, stderr=%d bytes", len(stdout), len(stderr))
             duration = int((time.time() - start_time) * 1000)
 
             result_data['duration_ms'] = duration
             result_data['claude_path'] = claude_path  # Include for debugging
 
+            # Output is collected as bytes and decoded once, as UTF-8 regardless
+            # of the locale codec (cp1252 on Windows would mangle it)
             if process.returncode == 0:
+                stdout = stdout.decode('utf-8', errors='replace')
                 result_data['response'] = stdout.strip()
                 result_data['response_size'] = len(stdout)
-                result_data['response_preview'] = stdout[:500] + ('...' if len(stdout) > 500 else '')
+                if debug:
+                    result_data['response_preview'] = stdout[:500] + ('...' if len(stdout) > 500 else '')
                 result_data['success'] = True
             else:
+                stderr = stderr.decode('utf-8', errors='replace')
                 result_data['response'] = f"Error (exit code {process.returncode}): {stderr}"
                 result_data['success'] = False
 
@@ -219,7 +565,7 @@ def query_claude(prompt: str, context: str = "", request_id: int = 0, model: str
             process.kill()
             try:
                 _, stderr_on_timeout = process.communicate(timeout=5)
-                logging.error(f"Stderr on timeout: {stderr_on_timeout[:1000] if stderr_on_timeout else 'empty'}")
+                logging.error(f"Stderr on timeout: {stderr_on_timeout[:1000].decode('utf-8', errors='replace') if stderr_on_timeout else 'empty'}")
             except:
                 pass
             duration = int((time.time() - start_time) * 1000)
@@ -228,8 +574,7 @@ def query_claude(prompt: str, context: str = "", request_id: int = 0, model: str
             result_data['success'] = False
 
         finally:
-            with process_lock:
-                active_processes.pop(request_id, None)
+            active_processes.pop(request_id, None)
 
     except FileNotFoundError as e:
         duration = int((time.time() - start_time) * 1000)
@@ -241,28 +586,26 @@ def query_claude(prompt: str, context: str = "", request_id: int = 0, model: str
         result_data['duration_ms'] = duration
         result_data['response'] = f"Error: {str(e)}"
         result_data['success'] = False
-    finally:
-        # Clean up temp file
-        if temp_file and os.path.exists(temp_file.name):
-            try:
-                os.unlink(temp_file.name)
-                logging.info(f"Cleaned up temp file: {temp_file.name}")
-            except Exception as e:
-                logging.warning(f"Failed to clean up temp file: {e}")
 
     return result_data
 
 
 def cancel_request(request_id: int) -> bool:
     """Cancel an active request by killing its subprocess."""
-    with process_lock:
-        process = active_processes.get(request_id)
-        if process:
-            try:
+    # Removing the entry lets the query tell a cancel apart from a crash
+    process = active_processes.pop(request_id, None)
+    if process:
+        with session_lock:
+            session = next((s for s in sessions.values() if s.process is process), None)
+        try:
+            if session is not None:
+                session.stop()
+            else:
+                # kill() is a no-op once the process has been reaped
                 process.kill()
-                return True
-            except Exception:
-                pass
+            return True
+        except Exception:
+            pass
     return False
 
 
@@ -270,121 +613,107 @@ def handle_message(message: Dict[str, Any]) -> Dict[str, Any]:
     """Process incoming message and return response."""
     action = message.get('action')
     request_id = message.get('requestId', 0)
-    logging.info(f"=== Received message: action={action}, requestId={request_id} ===")
+    logging.info("=== Received message: action=%s, requestId=%s ===", action, request_id)
 
-    response = {
-        'requestId': request_id,
-        'success': False,
-        'action': action
-    }
+    base = {'requestId': request_id, 'action': action}
 
     try:
+        # Checked first: it's the sidebar's connection check and only does a cached lookup
+        if action == 'ping':
+            # Also return claude path for debugging (cached after the first call)
+            claude_path = find_claude()
+            return {**base, 'success': True, 'result': 'pong', 'claude_path': claude_path or 'NOT FOUND'}
+
         if action == 'cancel':
             target_id = message.get('targetRequestId', 0)
             cancelled = cancel_request(target_id)
-            response['success'] = True
-            response['cancelled'] = cancelled
-            response['result'] = 'Request cancelled' if cancelled else 'No active request found'
-            return response
+            return {
+                **base,
+                'success': True,
+                'cancelled': cancelled,
+                'result': 'Request cancelled' if cancelled else 'No active request found'
+            }
+
+        debug = message.get('debug', False)
+        # Validate model once for every query action, default to sonnet if invalid
+        model = message.get('model', 'sonnet')
+        if model not in VALID_MODELS:
+            model = 'sonnet'
 
         if action == 'summarize':
             content = message.get('content', '')
-            model = message.get('model', 'sonnet')
             result = query_claude(
                 "Summarize the following web page content concisely:",
                 context=content,
                 request_id=request_id,
-                model=model
+                model=model,
+                debug=debug
             )
-            response.update(result)
-            response['result'] = result['response']
-            response['success'] = result['success']
 
         elif action == 'ask':
             question = message.get('question', '')
             content = message.get('content', '')
-            model = message.get('model', 'sonnet')
             result = query_claude(
                 question,
                 context=f"Based on this web page content:\n{content}",
                 request_id=request_id,
-                model=model
+                model=model,
+                debug=debug
             )
-            response.update(result)
-            response['result'] = result['response']
-            response['success'] = result['success']
 
         elif action == 'explain':
             selection = message.get('selection', '')
-            model = message.get('model', 'sonnet')
             result = query_claude(
                 f"Explain the following text or code snippet:\n{selection}",
                 request_id=request_id,
-                model=model
+                model=model,
+                debug=debug
             )
-            response.update(result)
-            response['result'] = result['response']
-            response['success'] = result['success']
 
         elif action == 'analyze_network':
             network_data = message.get('networkData', [])
-            model = message.get('model', 'sonnet')
             result = query_claude(
                 "Analyze this network activity and identify what's consuming the most resources. Provide insights on potential performance issues:",
-                context=json.dumps(network_data, indent=2),
+                context=json_encode(network_data).decode('utf-8'),
                 request_id=request_id,
-                model=model
+                model=model,
+                debug=debug
             )
-            response.update(result)
-            response['result'] = result['response']
-            response['success'] = result['success']
 
         elif action == 'suggest_dom_changes':
             html = message.get('html', '')
             request = message.get('request', '')
-            model = message.get('model', 'sonnet')
             result = query_claude(
-                f"""User request: {request}
-
-Suggest specific DOM changes as a JSON array. Each change should have:
-- "action": one of "setText", "setHTML", "setAttribute", "addClass", "removeClass", "setStyle", "remove"
-- "selector": CSS selector for the target element
-- For setText/setHTML: "value" with the new content
-- For setAttribute: "attribute" and "value"
-- For addClass/removeClass: "className"
-- For setStyle: "property" and "value"
-
-Example response format:
-```json
-[
-  {{"action": "setText", "selector": "h1.title", "value": "New Title"}},
-  {{"action": "setStyle", "selector": ".sidebar", "property": "display", "value": "none"}}
-]
-```
-
-Respond with ONLY the JSON array, no other text.""",
+                DOM_CHANGES_PROMPT.format(request=request),
                 context=f"Current HTML structure:\n{html[:20000]}",
                 request_id=request_id,
-                model=model
+                model=model,
+                debug=debug
             )
-            response.update(result)
-            response['result'] = result['response']
-            response['success'] = result['success']
-
-        elif action == 'ping':
-            # Also return claude path for debugging
-            claude_path = find_claude()
-            response['result'] = 'pong'
-            response['claude_path'] = claude_path or 'NOT FOUND'
-            response['success'] = True
 
         else:
-            response['error'] = f'Unknown action: {action}'
+            return {**base, 'success': False, 'error': f'Unknown action: {action}'}
 
     except Exception as e:
-        response['error'] = str(e)
+        return {**base, 'success': False, 'error': str(e)}
 
-    return response
+    # Query actions: the query metadata plus the response text as 'result'
+    return {**base, **result, 'result': result['response']}
+
+
+def process_message(message: Dict[str, Any]) -> None:
+    """Handle a message and send its response (runs on a worker thread)."""
+    if shutting_down.is_set():
+        # Still queued when the extension disconnected; nobody is waiting
+        return
+    try:
+        send_message(handle_message(message))
+    except Exception as e:
+        send_message({
+            'requestId': message.get('requestId', 0),
+            'success': False,
+            'error': str(e)
+        })
 
 
 def main():
@@ -395,8 +724,12 @@ def main():
             if message is None:
                 break
 
-            response = handle_message(message)
-            send_message(response)
+            # Cancel and ping are cheap, so they are answered inline and never
+            # queue behind busy workers
+            if message.get('action') in ('cancel', 'ping'):
+                process_message(message)
+            else:
+                executor.submit(process_message, message)
 
         except Exception as e:
             send_message({
@@ -404,6 +737,20 @@ def main():
                 'error': str(e)
             })
 
+    # Extension disconnected: nobody is left to read the results. Stop queued
+    # requests from starting claude, then kill whatever is already running.
+    shutting_down.set()
+    with session_lock:
+        running_sessions = list(sessions.values())
+    for session in running_sessions:
+        session.stop()
+    for process in list(active_processes.values()):
+        try:
+            process.kill()
+        except Exception:
+            pass
+    executor.shutdown(wait=True)
+
 
 if __name__ == '__main__':
     main()